@@ -0,0 +1,243 @@
+import os
+import math
+import time
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+from functools import wraps
+from urllib.parse import unquote
+from concurrent.futures import Future
+
+DISCOGS_TOKEN = os.environ["DISCOGS_TOKEN"]
+NOTION_TOKEN = os.environ["NOTION_TOKEN"]
+DATABASE_ID = os.environ["NOTION_DATABASE_ID"]
+
+DISCOGS_BASE = "https://api.discogs.com"
+NOTION_BASE = "https://api.notion.com/v1"
+DATABASE_QUERY_URL = f"{NOTION_BASE}/databases/{DATABASE_ID}/query"
+PAGES_URL = f"{NOTION_BASE}/pages"
+
+MAX_WORKERS = 8
+
+CACHE_DIR = os.path.expanduser("~/.cache/discogs-notion")
+
+# Each script sets its own User-Agent on discogs_session
+headers_discogs = {
+    "Authorization": f"Discogs token={DISCOGS_TOKEN}"
+}
+
+headers_notion = {
+    "Authorization": f"Bearer {NOTION_TOKEN}",
+    "Content-Type": "application/json",
+    "Notion-Version": "2022-06-28"
+}
+
+# ---------------------------------------------------
+# REQUEST HELPERS
+# ---------------------------------------------------
+
+def make_session(headers):
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=MAX_WORKERS,
+        pool_block=True,
+        # Connection errors only; 429/5xx responses (and their Retry-After)
+        # are handled by retry_request so they go through the buckets
+        max_retries=Retry(total=3, backoff_factor=0.3, respect_retry_after_header=False)
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+discogs_session = make_session(headers_discogs)
+notion_session = make_session(headers_notion)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        # Push the next token at least `seconds` into the future
+        with self.lock:
+            # Refill up to now first, so acquire() doesn't credit the time
+            # before the hold against it
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+# Discogs allows 60 authenticated requests per moving minute, Notion ~3/s
+discogs_bucket = TokenBucket(1, 1)
+notion_bucket = TokenBucket(3, 3)
+
+# Cap in-flight requests per host independently of MAX_WORKERS
+discogs_slots = threading.BoundedSemaphore(4)
+notion_slots = threading.BoundedSemaphore(3)
+
+# Back off when Discogs reports the shared per-token budget is nearly spent,
+# e.g. while the other sync script is running
+DISCOGS_LOW_REMAINING = 5
+
+
+MAX_ATTEMPTS = 6
+
+# Give up on a request rather than sleep longer than this in total, so a
+# huge Retry-After can't stall a worker for the rest of the run
+MAX_RETRY_WAIT = 120
+
+# Other 4xx/5xx (404, 401, 501...) won't succeed on a retry
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def backoff_delay(r, attempt):
+    retry_after = r.headers.get("Retry-After")
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            delay = None
+        # Negative, inf or nan would crash time.sleep or dodge MAX_RETRY_WAIT
+        if delay is not None and math.isfinite(delay) and delay >= 0:
+            return delay
+    return min(60, (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def retry_request(session, bucket, slots, method, url, idempotent=True, **kwargs):
+    waited = 0
+    for attempt in range(MAX_ATTEMPTS):
+        bucket.acquire()
+        with slots:
+            r = session.request(method, url, **kwargs)
+
+        if r.status_code not in RETRYABLE_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            return r
+
+        # A 5xx on page creation may still have created the page, so only
+        # retry 429 there; queries are POSTs too but safe to repeat
+        if not idempotent and r.status_code != 429:
+            return r
+
+        delay = backoff_delay(r, attempt)
+        if waited + delay > MAX_RETRY_WAIT:
+            return r
+
+        time.sleep(delay)
+        waited += delay
+
+
+def discogs_request(url, params=None):
+    r = retry_request(discogs_session, discogs_bucket, discogs_slots, "GET", url, params=params)
+
+    remaining = r.headers.get("X-Discogs-Ratelimit-Remaining")
+    if remaining and remaining.isdigit() and int(remaining) < DISCOGS_LOW_REMAINING:
+        discogs_bucket.hold(DISCOGS_LOW_REMAINING - int(remaining))
+
+    if not r.ok:
+        print(f"DISCOGS ERROR {r.status_code} for {url}")
+        return None
+    return r
+
+
+def notion_request(method, url, payload=None, params=None):
+    idempotent = not (method == "POST" and url == PAGES_URL)
+    r = retry_request(
+        notion_session, notion_bucket, notion_slots, method, url,
+        idempotent=idempotent, json=payload, params=params
+    )
+    if not r.ok:
+        print("NOTION ERROR:", r.status_code, r.text)
+        return None
+    return r
+
+
+def once_per_release(fn):
+    # Concurrent workers asking for the same release wait on the first
+    # caller's request instead of issuing their own.
+    results = {}
+    lock = threading.Lock()
+
+    @wraps(fn)
+    def wrapper(release_id):
+        with lock:
+            future = results.get(release_id)
+            owner = future is None
+            if owner:
+                future = results[release_id] = Future()
+
+        if owner:
+            try:
+                future.set_result(fn(release_id))
+            except BaseException as e:
+                future.set_exception(e)
+
+        return future.result()
+
+    return wrapper
+
+
+# ---------------------------------------------------
+# DISCOGS VALUES
+# ---------------------------------------------------
+
+# Copies of the same release are priced once per run
+@once_per_release
+def get_market_values(release_id):
+    lowest = median = highest = None
+
+    # Lowest ever sold
+    r_stats = discogs_request(f"{DISCOGS_BASE}/marketplace/stats/{release_id}")
+    if r_stats:
+        lp = r_stats.json().get("lowest_price")
+        if lp:
+            lowest = lp.get("value")
+
+    # VG+ and Mint suggestions
+    r_price = discogs_request(f"{DISCOGS_BASE}/marketplace/price_suggestions/{release_id}")
+    if r_price:
+        data = r_price.json()
+
+        if data.get("Very Good Plus (VG+)"):
+            median = data["Very Good Plus (VG+)"]["value"]
+
+        if data.get("Mint (M)"):
+            highest = data["Mint (M)"]["value"]
+
+    return lowest, median, highest
+
+
+# ---------------------------------------------------
+# NOTION SCHEMA
+# ---------------------------------------------------
+
+def get_property_ids(names):
+    # Query results can be trimmed to these properties with filter_properties,
+    # which only accepts property IDs, not names.
+    r = notion_request("GET", f"{NOTION_BASE}/databases/{DATABASE_ID}")
+    if not r:
+        return None
+
+    properties = r.json().get("properties", {})
+    ids = [unquote(properties[name]["id"]) for name in names if name in properties]
+    return ids or None
@@ -1,171 +1,159 @@
 import os
-import time
-import requests
+from collections import Counter
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-DISCOGS_TOKEN = os.environ["DISCOGS_TOKEN"]
-NOTION_TOKEN = os.environ["NOTION_TOKEN"]
-DATABASE_ID = os.environ["NOTION_DATABASE_ID"]
+from discogs_notion_common import (
+    CACHE_DIR,
+    DATABASE_QUERY_URL,
+    MAX_WORKERS,
+    NOTION_BASE,
+    discogs_session,
+    get_market_values,
+    get_property_ids,
+    notion_request,
+)
 
-DISCOGS_BASE = "https://api.discogs.com"
-NOTION_BASE = "https://api.notion.com/v1"
+LAST_RUN_PATH = os.path.join(CACHE_DIR, "last_value_run")
 
-headers_discogs = {
-    "Authorization": f"Discogs token={DISCOGS_TOKEN}",
-    "User-Agent": "discogs-notion-value-sync/1.0"
-}
+discogs_session.headers["User-Agent"] = "discogs-notion-value-sync/1.0"
 
-headers_notion = {
-    "Authorization": f"Bearer {NOTION_TOKEN}",
-    "Content-Type": "application/json",
-    "Notion-Version": "2022-06-28"
-}
 
 # ---------------------------------------------------
-# REQUEST HELPERS (same behaviour as main script)
+# LAST RUN STATE
 # ---------------------------------------------------
 
-def discogs_request(url):
-    while True:
-        r = requests.get(url, headers=headers_discogs)
-
-        if r.status_code == 429:
-            retry = int(r.headers.get("Retry-After", 5))
-            time.sleep(retry)
-            continue
-
-        if r.status_code >= 500:
-            print(f"DISCOGS ERROR {r.status_code} for {url}")
-            time.sleep(2)
-            return None
-
-        if not r.ok:
-            print(f"DISCOGS ERROR {r.status_code} for {url}")
-            return None
-
-        return r
-
-
-def notion_request(method, url, payload=None):
-    r = requests.request(method, url, headers=headers_notion, json=payload)
-    if not r.ok:
-        print("NOTION ERROR:", r.status_code, r.text)
+def load_last_run():
+    try:
+        with open(LAST_RUN_PATH) as f:
+            return f.read().strip() or None
+    except OSError:
         return None
-    return r
 
 
-# ---------------------------------------------------
-# DISCOGS VALUES (identical logic to main script)
-# ---------------------------------------------------
-
-def get_market_values(release_id):
-    lowest = median = highest = None
-
-    # Lowest ever sold
-    r_stats = discogs_request(f"{DISCOGS_BASE}/marketplace/stats/{release_id}")
-    if r_stats:
-        lp = r_stats.json().get("lowest_price")
-        if lp:
-            lowest = lp.get("value")
-
-    # VG+ and Mint suggestions
-    r_price = discogs_request(f"{DISCOGS_BASE}/marketplace/price_suggestions/{release_id}")
-    if r_price:
-        data = r_price.json()
-
-        if data.get("Very Good Plus (VG+)"):
-            median = data["Very Good Plus (VG+)"]["value"]
-
-        if data.get("Mint (M)"):
-            highest = data["Mint (M)"]["value"]
-
-    return lowest, median, highest
+def save_last_run():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(LAST_RUN_PATH, "w") as f:
+        f.write(datetime.now(timezone.utc).isoformat())
 
 
 # ---------------------------------------------------
-# FETCH ALL NOTION PAGES
+# STREAM NOTION PAGES
 # ---------------------------------------------------
 
-def fetch_all_pages():
-    pages = []
+def iter_pages(last_run=None):
     has_more = True
     start_cursor = None
+    property_ids = get_property_ids(["Discogs ID", "ValueLow", "ValueMed", "ValueHigh"])
+
+    # Rows without a Discogs ID have nothing to price
+    query_filter = {"property": "Discogs ID", "number": {"is_not_empty": True}}
+
+    # Only reprice pages last edited before the previous value run, assuming
+    # later edits came from sync.py writing fresh values. Manual edits in
+    # Notion also count, so those pages wait a run; pages with any value
+    # missing (e.g. /price_suggestions failed) are always repriced.
+    if last_run:
+        query_filter = {
+            "and": [
+                query_filter,
+                {
+                    "or": [
+                        {"property": "ValueLow", "number": {"is_empty": True}},
+                        {"property": "ValueMed", "number": {"is_empty": True}},
+                        {"property": "ValueHigh", "number": {"is_empty": True}},
+                        {"timestamp": "last_edited_time", "last_edited_time": {"before": last_run}},
+                    ]
+                },
+            ]
+        }
 
     while has_more:
-        payload = {"page_size": 100}
+        payload = {"page_size": 100, "filter": query_filter}
         if start_cursor:
             payload["start_cursor"] = start_cursor
 
         r = notion_request(
             "POST",
-            f"{NOTION_BASE}/databases/{DATABASE_ID}/query",
-            payload
+            DATABASE_QUERY_URL,
+            payload,
+            {"filter_properties": property_ids}
         )
 
+        # Fail the run (and keep the previous last_run) rather than stop quietly
         if not r:
-            break
+            raise SystemExit("Could not fetch all Notion pages, aborting")
 
         data = r.json()
 
         for result in data.get("results", []):
             props = result["properties"]
+            discogs_id = props["Discogs ID"]["number"]
 
-            pages.append({
+            yield {
                 "page_id": result["id"],
-                "discogs_id": props["Discogs ID"]["number"],
+                # int() so a 1234.0 from Notion builds /stats/1234, not /stats/1234.0
+                "discogs_id": int(discogs_id) if discogs_id else None,
                 "low": props["ValueLow"]["number"],
                 "med": props["ValueMed"]["number"],
                 "high": props["ValueHigh"]["number"]
-            })
+            }
 
         has_more = data.get("has_more")
         start_cursor = data.get("next_cursor")
 
-    return pages
-
 
 # ---------------------------------------------------
-# MAIN
+# UPDATE ONE PAGE
 # ---------------------------------------------------
 
-def main():
-    print("Fetching Notion pages...")
-    pages = fetch_all_pages()
+def update_page_values(page):
+    release_id = page["discogs_id"]
+    if not release_id:
+        return "skipped"
 
-    updated = 0
-    skipped = 0
+    lowest, median, highest = get_market_values(release_id)
 
-    for page in pages:
+    # Only update if changed
+    if (
+        page["low"] == lowest and
+        page["med"] == median and
+        page["high"] == highest
+    ):
+        return "skipped"
 
-        release_id = page["discogs_id"]
-        if not release_id:
-            skipped += 1
-            continue
+    properties = {
+        "ValueLow": {"number": lowest},
+        "ValueMed": {"number": median},
+        "ValueHigh": {"number": highest},
+    }
 
-        lowest, median, highest = get_market_values(release_id)
+    r = notion_request(
+        "PATCH",
+        f"{NOTION_BASE}/pages/{page['page_id']}",
+        {"properties": properties}
+    )
 
-        # Only update if changed
-        if (
-            page["low"] == lowest and
-            page["med"] == median and
-            page["high"] == highest
-        ):
-            skipped += 1
-            continue
+    if r:
+        return "updated"
+    return None
 
-        properties = {
-            "ValueLow": {"number": lowest},
-            "ValueMed": {"number": median},
-            "ValueHigh": {"number": highest},
-        }
 
-        r = notion_request(
-            "PATCH",
-            f"{NOTION_BASE}/pages/{page['page_id']}",
-            {"properties": properties}
-        )
+# ---------------------------------------------------
+# MAIN
+# ---------------------------------------------------
+
+def main():
+    print("Fetching Notion pages...")
+
+    # Workers start pricing the first batch while later batches are fetched
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = Counter(executor.map(update_page_values, iter_pages(load_last_run())))
+
+    updated = results["updated"]
+    skipped = results["skipped"]
 
-        if r:
-            updated += 1
+    save_last_run()
 
     print("Value sync complete.")
     print("Updated:", updated)
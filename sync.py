@@ -1,99 +1,115 @@
 import os
-import time
+import argparse
 import re
-import requests
+import json
 import hashlib
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import lru_cache
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+
+from discogs_notion_common import (
+    CACHE_DIR,
+    DATABASE_ID,
+    DATABASE_QUERY_URL,
+    DISCOGS_BASE,
+    MAX_WORKERS,
+    NOTION_BASE,
+    PAGES_URL,
+    discogs_request,
+    discogs_session,
+    get_market_values,
+    get_property_ids,
+    notion_request,
+    once_per_release,
+)
 
-DISCOGS_TOKEN = os.environ["DISCOGS_TOKEN"]
-NOTION_TOKEN = os.environ["NOTION_TOKEN"]
-DATABASE_ID = os.environ["NOTION_DATABASE_ID"]
 USERNAME = os.environ["DISCOGS_USERNAME"]
 
-DISCOGS_BASE = "https://api.discogs.com"
-NOTION_BASE = "https://api.notion.com/v1"
+COLLECTION_URL = f"{DISCOGS_BASE}/users/{USERNAME}/collection/folders/0/releases"
 
-headers_discogs = {
-    "Authorization": f"Discogs token={DISCOGS_TOKEN}",
-    "User-Agent": "discogs-notion-sync/7.2"
-}
-
-headers_notion = {
-    "Authorization": f"Bearer {NOTION_TOKEN}",
-    "Content-Type": "application/json",
-    "Notion-Version": "2022-06-28"
-}
-
-# ---------------------------------------------------
-# REQUEST HELPERS
-# ---------------------------------------------------
-
-def discogs_request(url):
-    while True:
-        r = requests.get(url, headers=headers_discogs)
-
-        if r.status_code == 429:
-            retry = int(r.headers.get("Retry-After", 5))
-            time.sleep(retry)
-            continue
-
-        if r.status_code >= 500:
-            print(f"DISCOGS ERROR {r.status_code} for {url}")
-            time.sleep(2)
-            return None
-
-        if not r.ok:
-            print(f"DISCOGS ERROR {r.status_code} for {url}")
-            return None
-
-        return r
-
-
-def notion_request(method, url, payload=None):
-    r = requests.request(method, url, headers=headers_notion, json=payload)
-    if not r.ok:
-        print("NOTION ERROR:", r.status_code, r.text)
-        return None
-    return r
+RELEASE_CACHE_PATH = os.path.join(CACHE_DIR, "releases.json")
 
+discogs_session.headers["User-Agent"] = "discogs-notion-sync/7.2"
 
 # ---------------------------------------------------
 # UTIL
 # ---------------------------------------------------
 
-RPM_PATTERN = re.compile(r"\b(33\s?⅓|33\s?1/3|33|45|78)\s?RPM\b", re.IGNORECASE)
-SIZE_PATTERN = re.compile(r'\b(7"|10"|12")')
+# One pass finds the size and speed tokens in a description
+FORMAT_PATTERN = re.compile(
+    r'(?P<size>\b(?:7"|10"|12"))|(?P<speed>\b(?:33\s?⅓|33\s?1/3|33|45|78)\s?RPM\b)',
+    re.IGNORECASE
+)
+
+# Exact Discogs spellings skip the regex; anything else falls back to it
+KNOWN_SIZES = frozenset({'7"', '10"', '12"'})
+KNOWN_SPEEDS = frozenset({"33 ⅓ RPM", "45 RPM", "78 RPM"})
 
 
 def parse_formats(formats):
     if not formats:
         return None, None, None
 
+    return parse_descriptions(tuple(desc for fmt in formats for desc in fmt.get("descriptions", [])))
+
+
+# Most of a collection shares a handful of description lists
+@lru_cache(maxsize=4096)
+def parse_descriptions(descriptions):
     size = None
     speed = None
     details = []
+    finditer = FORMAT_PATTERN.finditer
 
-    for fmt in formats:
-        for desc in fmt.get("descriptions", []):
-            normalized = desc.replace("⅓", "1/3")
-
-            if not size and SIZE_PATTERN.search(desc):
-                size = desc
-                continue
+    for i, desc in enumerate(descriptions):
+        if size and speed:
+            # Everything left is a detail, no need to test it
+            details.extend(descriptions[i:])
+            break
 
-            if not speed and RPM_PATTERN.search(normalized):
-                speed = desc
-                continue
+        if desc in KNOWN_SIZES:
+            kinds = ("size",)
+        elif desc in KNOWN_SPEEDS:
+            kinds = ("speed",)
+        else:
+            # A description may hold both tokens, e.g. '45 RPM 7"'
+            kinds = {m.lastgroup for m in finditer(desc)}
 
+        if "size" in kinds and not size:
+            size = desc
+        elif "speed" in kinds and not speed:
+            speed = desc
+        else:
             details.append(desc)
 
     return size, speed, ", ".join(details) if details else None
 
 
+get_name = itemgetter("name")
+
+
+def join_names(entries):
+    # Most releases credit a single artist
+    if len(entries) == 1:
+        return entries[0]["name"]
+    return ", ".join(map(get_name, entries))
+
+
 def clean_multiselect(value):
     return value.replace(",", "").strip() if value else value
 
 
+def rich_text(value):
+    return {"rich_text": [{"text": {"content": value or ""}}]}
+
+
+def read_rich_text(prop):
+    if prop and prop["rich_text"]:
+        return prop["rich_text"][0]["text"]["content"]
+    return ""
+
+
 def compute_hash(d):
     return hashlib.md5("|".join(str(v or "") for v in d.values()).encode()).hexdigest()
 
@@ -102,47 +118,54 @@ def compute_hash(d):
 # DISCOGS FETCH
 # ---------------------------------------------------
 
+def get_collection_page(page):
+    r = discogs_request(COLLECTION_URL, {"page": page, "per_page": 100})
+    return r.json() if r else {}
+
+
 def get_full_collection():
-    releases = []
-    page = 1
-    while True:
-        url = f"{DISCOGS_BASE}/users/{USERNAME}/collection/folders/0/releases?page={page}&per_page=100"
-        r = discogs_request(url)
-        if not r:
-            break
-        data = r.json()
-        releases.extend(data.get("releases", []))
-        if page >= data.get("pagination", {}).get("pages", 1):
-            break
-        page += 1
+    first = get_collection_page(1)
+    releases = first.get("releases", [])
+    pages = first.get("pagination", {}).get("pages", 1)
+
+    # Page count is known after the first response, so fetch the rest in parallel
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for data in executor.map(get_collection_page, range(2, pages + 1)):
+            releases.extend(data.get("releases", []))
+
     return releases
 
 
-def get_release_country(release_id):
-    r = discogs_request(f"{DISCOGS_BASE}/releases/{release_id}")
-    if r:
-        return r.json().get("country")
-    return None
+# Release metadata is effectively immutable, so countries fetched from
+# /releases/{id} are kept on disk between runs.
+release_cache = {}
 
 
-def get_market_values(release_id):
-    lowest = median = highest = None
+def load_release_cache():
+    try:
+        with open(RELEASE_CACHE_PATH) as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
 
-    r_stats = discogs_request(f"{DISCOGS_BASE}/marketplace/stats/{release_id}")
-    if r_stats:
-        lp = r_stats.json().get("lowest_price")
-        if lp:
-            lowest = lp.get("value")
 
-    r_price = discogs_request(f"{DISCOGS_BASE}/marketplace/price_suggestions/{release_id}")
-    if r_price:
-        data = r_price.json()
-        if data.get("Very Good Plus (VG+)"):
-            median = data["Very Good Plus (VG+)"]["value"]
-        if data.get("Mint (M)"):
-            highest = data["Mint (M)"]["value"]
+def save_release_cache():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(RELEASE_CACHE_PATH, "w") as f:
+        json.dump(release_cache, f)
+
+
+@once_per_release
+def get_release_country(release_id):
+    if release_id in release_cache:
+        return release_cache[release_id]
 
-    return lowest, median, highest
+    r = discogs_request(f"{DISCOGS_BASE}/releases/{release_id}")
+    if r:
+        country = r.json().get("country")
+        release_cache[release_id] = country
+        return country
+    return None
 
 
 def get_folder_map():
@@ -163,20 +186,28 @@ def fetch_existing_pages():
     pages = {}
     has_more = True
     start_cursor = None
+    property_ids = get_property_ids(["Instance ID", "SyncHash"])
 
     while has_more:
-        payload = {"page_size": 100}
+        # Rows without an Instance ID can't be matched to the collection
+        payload = {
+            "page_size": 100,
+            "filter": {"property": "Instance ID", "number": {"is_not_empty": True}}
+        }
         if start_cursor:
             payload["start_cursor"] = start_cursor
 
         r = notion_request(
             "POST",
-            f"{NOTION_BASE}/databases/{DATABASE_ID}/query",
-            payload
+            DATABASE_QUERY_URL,
+            payload,
+            {"filter_properties": property_ids}
         )
 
+        # A partial map would make sync_item create duplicates of the
+        # pages it never saw, so stop the run instead
         if not r:
-            break
+            raise SystemExit("Could not fetch all existing Notion pages, aborting")
 
         data = r.json()
 
@@ -184,12 +215,11 @@ def fetch_existing_pages():
             props = result["properties"]
             instance_id = props["Instance ID"]["number"]
 
-            existing_hash = ""
-            if props.get("SyncHash") and props["SyncHash"]["rich_text"]:
-                existing_hash = props["SyncHash"]["rich_text"][0]["text"]["content"]
+            existing_hash = read_rich_text(props.get("SyncHash"))
 
+            # Notion may hand back 1234.0; key on int so Discogs' 1234 matches
             if instance_id:
-                pages[instance_id] = {
+                pages[int(instance_id)] = {
                     "page_id": result["id"],
                     "hash": existing_hash
                 }
@@ -200,156 +230,217 @@ def fetch_existing_pages():
     return pages
 
 
+# ---------------------------------------------------
+# NOTION PROPERTIES
+# ---------------------------------------------------
+
+# (Notion property, metadata key) pairs
+RICH_TEXT_FIELDS = [
+    ("Artist", "artist"),
+    ("Label", "label"),
+    ("CatNo", "catno"),
+    ("FormatDetails", "details"),
+]
+
+# Select properties are only sent when they have a value
+SELECT_FIELDS = [
+    ("Country", "country"),
+    ("Folder", "folder"),
+    ("Media Condition", "media"),
+    ("Sleeve Condition", "sleeve"),
+    ("FormatSize", "size"),
+    ("FormatSpeed", "speed"),
+]
+
+
+def build_properties(item, metadata, genres, styles, values, sync_hash):
+    lowest, median, highest = values
+
+    properties = {
+        "Title": {"title": [{"text": {"content": metadata["title"] or ""}}]},
+        "Discogs ID": {"number": item["basic_information"]["id"]},
+        "Instance ID": {"number": item["instance_id"]},
+        "Year": {"number": metadata["year"]},
+        "LabelCount": {"number": metadata["label_count"]},
+        "Qty": {"number": metadata["qty"]},
+        "Genre": {"multi_select": [{"name": g} for g in genres]},
+        "Style": {"multi_select": [{"name": s} for s in styles]},
+        "ValueLow": {"number": lowest},
+        "ValueMed": {"number": median},
+        "ValueHigh": {"number": highest},
+        "SyncHash": rich_text(sync_hash),
+    }
+
+    for name, key in RICH_TEXT_FIELDS:
+        properties[name] = rich_text(metadata[key])
+
+    for name, key in SELECT_FIELDS:
+        if metadata[key]:
+            properties[name] = {"select": {"name": metadata[key]}}
+
+    date_added = item.get("date_added")
+    if date_added:
+        properties["Added"] = {"date": {"start": date_added}}
+
+    if metadata["notes"]:
+        properties["Notes"] = rich_text(metadata["notes"])
+
+    return properties
+
+
+# ---------------------------------------------------
+# SYNC ONE ITEM
+# ---------------------------------------------------
+
+def sync_item(item, notion_pages, folder_map, field_map, label_counts, release_counts, force=False):
+
+    basic = item["basic_information"]
+    release_id = basic["id"]
+    instance_id = item["instance_id"]
+
+    qty = release_counts.get(release_id, 0)
+
+    folder = folder_map.get(item.get("folder_id"))
+
+    media = sleeve = None
+    real_notes = []
+
+    for n in item.get("notes", []):
+        field_name = field_map.get(n.get("field_id"))
+        value = n.get("value")
+        if not value:
+            continue
+        if field_name == "Media Condition":
+            media = value
+        elif field_name == "Sleeve Condition":
+            sleeve = value
+        else:
+            real_notes.append(value)
+
+    notes = "\n".join(real_notes) if real_notes else None
+
+    labels = basic.get("labels") or []
+    label = labels[0]["name"] if labels else None
+    catno = labels[0]["catno"] if labels else None
+
+    genres = [clean_multiselect(g) for g in (basic.get("genres") or [])]
+    styles = [clean_multiselect(s) for s in (basic.get("styles") or [])]
+
+    size, speed, details = parse_formats(basic.get("formats"))
+
+    country = basic.get("country")
+    if not country:
+        country = get_release_country(release_id)
+
+    label_count = label_counts.get(label, 0)
+
+    metadata_hash_payload = {
+        "title": basic.get("title"),
+        "artist": join_names(basic.get("artists") or ()),
+        "year": basic.get("year"),
+        "label": label,
+        "catno": catno,
+        "country": country,
+        "folder": folder,
+        "media": media,
+        "sleeve": sleeve,
+        "notes": notes,
+        "size": size,
+        "speed": speed,
+        "details": details,
+        "genres": ",".join(genres),
+        "styles": ",".join(styles),
+        "label_count": label_count,
+        "qty": qty
+    }
+
+    new_hash = compute_hash(metadata_hash_payload)
+    existing = notion_pages.get(instance_id)
+
+    if existing and existing["hash"] == new_hash and not force:
+        return "skipped"
+
+    lowest, median, highest = get_market_values(release_id)
+
+    properties = build_properties(item, metadata_hash_payload, genres, styles, (lowest, median, highest), new_hash)
+
+    if existing:
+        r = notion_request(
+            "PATCH",
+            f"{NOTION_BASE}/pages/{existing['page_id']}",
+            {"properties": properties}
+        )
+        if r:
+            return "updated"
+    else:
+        r = notion_request(
+            "POST",
+            PAGES_URL,
+            {"parent": {"database_id": DATABASE_ID}, "properties": properties}
+        )
+        if r:
+            return "created"
+
+    return None
+
+
 # ---------------------------------------------------
 # MAIN
 # ---------------------------------------------------
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync a Discogs collection to a Notion database")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="ignore cached release lookups and fetch them again (the cache is rewritten)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rewrite every page even when its SyncHash is unchanged"
+    )
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
 
     print("Phase 1 — Fetching collection")
     collection = get_full_collection()
+    if not args.no_cache:
+        release_cache.update(load_release_cache())
     folder_map = get_folder_map()
     field_map = get_collection_fields()
 
     # ----------------------------
-    # Build label counts
+    # Build label and release counts (Qty) in one pass
     # ----------------------------
     label_counts = defaultdict(int)
+    release_counts = defaultdict(int)
     for item in collection:
-        labels = item["basic_information"].get("labels") or []
+        basic = item["basic_information"]
+        labels = basic.get("labels") or []
         if labels:
             label_counts[labels[0]["name"]] += 1
-
-    # ----------------------------
-    # Build release counts (Qty)
-    # ----------------------------
-    release_counts = defaultdict(int)
-    for item in collection:
-        release_id = item["basic_information"]["id"]
-        release_counts[release_id] += 1
+        release_counts[basic["id"]] += 1
 
     print("Phase 2 — Fetching Notion pages")
     notion_pages = fetch_existing_pages()
 
-    created = updated = skipped = 0
-
-    for item in collection:
-
-        basic = item["basic_information"]
-        release_id = basic["id"]
-        instance_id = item["instance_id"]
-
-        qty = release_counts.get(release_id, 0)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = Counter(executor.map(
+            lambda item: sync_item(
+                item, notion_pages, folder_map, field_map, label_counts, release_counts, args.force
+            ),
+            collection
+        ))
 
-        folder = folder_map.get(item.get("folder_id"))
-        date_added = item.get("date_added")
+    created = results["created"]
+    updated = results["updated"]
+    skipped = results["skipped"]
 
-        media = sleeve = None
-        real_notes = []
-
-        for n in item.get("notes", []):
-            field_name = field_map.get(n.get("field_id"))
-            value = n.get("value")
-            if not value:
-                continue
-            if field_name == "Media Condition":
-                media = value
-            elif field_name == "Sleeve Condition":
-                sleeve = value
-            else:
-                real_notes.append(value)
-
-        notes = "\n".join(real_notes) if real_notes else None
-
-        labels = basic.get("labels") or []
-        label = labels[0]["name"] if labels else None
-        catno = labels[0]["catno"] if labels else None
-
-        genres = [clean_multiselect(g) for g in (basic.get("genres") or [])]
-        styles = [clean_multiselect(s) for s in (basic.get("styles") or [])]
-
-        size, speed, details = parse_formats(basic.get("formats"))
-
-        country = basic.get("country")
-        if not country:
-            country = get_release_country(release_id)
-
-        label_count = label_counts.get(label, 0)
-
-        metadata_hash_payload = {
-            "title": basic.get("title"),
-            "artist": ", ".join(a["name"] for a in basic.get("artists", [])),
-            "year": basic.get("year"),
-            "label": label,
-            "catno": catno,
-            "country": country,
-            "folder": folder,
-            "media": media,
-            "sleeve": sleeve,
-            "notes": notes,
-            "size": size,
-            "speed": speed,
-            "details": details,
-            "genres": ",".join(genres),
-            "styles": ",".join(styles),
-            "label_count": label_count,
-            "qty": qty
-        }
-
-        new_hash = compute_hash(metadata_hash_payload)
-        existing = notion_pages.get(instance_id)
-
-        if existing and existing["hash"] == new_hash:
-            skipped += 1
-            continue
-
-        lowest, median, highest = get_market_values(release_id)
-
-        properties = {
-            "Title": {"title": [{"text": {"content": basic.get("title", "")}}]},
-            "Artist": {"rich_text": [{"text": {"content": ", ".join(a["name"] for a in basic.get("artists", []))}}]},
-            "Discogs ID": {"number": release_id},
-            "Instance ID": {"number": instance_id},
-            "Year": {"number": basic.get("year")},
-            "Label": {"rich_text": [{"text": {"content": label or ""}}]},
-            "LabelCount": {"number": label_count},
-            "Qty": {"number": qty},
-            "CatNo": {"rich_text": [{"text": {"content": catno or ""}}]},
-            "Country": {"select": {"name": country}} if country else None,
-            "Folder": {"select": {"name": folder}} if folder else None,
-            "Media Condition": {"select": {"name": media}} if media else None,
-            "Sleeve Condition": {"select": {"name": sleeve}} if sleeve else None,
-            "Added": {"date": {"start": date_added}} if date_added else None,
-            "FormatSize": {"select": {"name": size}} if size else None,
-            "FormatSpeed": {"select": {"name": speed}} if speed else None,
-            "FormatDetails": {"rich_text": [{"text": {"content": details or ""}}]},
-            "Genre": {"multi_select": [{"name": g} for g in genres]},
-            "Style": {"multi_select": [{"name": s} for s in styles]},
-            "ValueLow": {"number": lowest},
-            "ValueMed": {"number": median},
-            "ValueHigh": {"number": highest},
-            "Notes": {"rich_text": [{"text": {"content": notes}}]} if notes else None,
-            "SyncHash": {"rich_text": [{"text": {"content": new_hash}}]},
-        }
-
-        properties = {k: v for k, v in properties.items() if v is not None}
-
-        if existing:
-            r = notion_request(
-                "PATCH",
-                f"{NOTION_BASE}/pages/{existing['page_id']}",
-                {"properties": properties}
-            )
-            if r:
-                updated += 1
-        else:
-            r = notion_request(
-                "POST",
-                f"{NOTION_BASE}/pages",
-                {"parent": {"database_id": DATABASE_ID}, "properties": properties}
-            )
-            if r:
-                created += 1
+    save_release_cache()
 
     print("Sync complete.")
     print("Created:", created)